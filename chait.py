@@ -1,7 +1,12 @@
-import os
+import contextvars
+import numpy as np
+import openpyxl
 import pandas as pd
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 
  
 # Set Streamlit page configuration
@@ -11,66 +16,101 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
  
-# Ensure a temporary directory exists
-TEMP_DIR = "temp_uploaded_files"
-os.makedirs(TEMP_DIR, exist_ok=True)
+# Upper bound on files parsed in parallel when appending
+MAX_READ_WORKERS = 8
 
-# Function to Convert DataFrame to Excel
-def convert_df_to_excel(df):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Sheet1')
-    return output.getvalue()
- 
-# Cache data to improve speed
-@st.cache_data(show_spinner=False)
-def read_csv(file):
-    """Read a CSV file."""
+# Function to Convert DataFrame to CSV
+def convert_df_to_csv(df):
+    return df.to_csv(index=False).encode()
+
+def mangle_columns(df):
+    """Rename blank and duplicate headers the way pandas' C parser does."""
+    columns = [f"Unnamed: {i}" if col == "" else col for i, col in enumerate(df.columns)]
+    counts = {}
+    for i, col in enumerate(columns):
+        name = col
+        count = counts.get(col, 0)
+        while count > 0:
+            counts[name] = count + 1
+            col = f"{name}.{count}"
+            count = count + 1 if col in columns else counts.get(col, 0)
+        columns[i] = col
+        counts[col] = count + 1
+    df.columns = columns
+    return df
+ 
+def parse_csv(file):
+    """Parse a CSV file, preferring the PyArrow reader."""
     try:
-        return pd.read_csv(file, encoding="ISO-8859-1")
+        try:
+            df = pd.read_csv(file, encoding="ISO-8859-1", engine="pyarrow", dtype_backend="pyarrow")
+        except pd.errors.ParserError:
+            # PyArrow rejects ragged rows that the C parser pads with missing values
+            file.seek(0)
+            return pd.read_csv(file, encoding="ISO-8859-1", dtype_backend="pyarrow")
+        # The PyArrow engine keeps blank and duplicate headers as they are
+        return mangle_columns(df)
     except Exception as e:
         st.error(f"Error reading CSV file: {e}")
         return None
  
+# Cache data to improve speed
 @st.cache_data(show_spinner=False)
+def read_csv(file):
+    """Read a CSV file."""
+    return parse_csv(file)
+ 
+@st.cache_data(show_spinner=False, hash_funcs={UploadedFile: lambda f: f.file_id})
 def read_excel(file):
     """Read an Excel file and return sheet names."""
     try:
-        excel_file = pd.ExcelFile(file, engine="openpyxl")
-        return excel_file.sheet_names
+        wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            return wb.sheetnames
+        finally:
+            wb.close()
     except Exception as e:
         st.error(f"Error reading Excel file: {e}")
         return None
  
-def load_excel_sheet(file, sheet_name):
+def load_excel_sheet(file, sheet_name=0):
     """Load a specific sheet from an Excel file."""
     try:
+        # pandas' openpyxl reader already streams the sheet in read-only mode
         return pd.read_excel(file, sheet_name=sheet_name, engine="openpyxl")
     except Exception as e:
         st.error(f"Error reading sheet '{sheet_name}': {e}")
         return None
  
 @st.cache_data(show_spinner=False)
+def load_any(file_bytes, name):
+    """Load an uploaded CSV or Excel file from its raw bytes."""
+    if name.endswith(".csv"):
+        return parse_csv(BytesIO(file_bytes))
+    return load_excel_sheet(BytesIO(file_bytes))
+ 
 def validate_columns(dfs):
     """Check if all dataframes have identical columns."""
-    columns_list = [set(df.columns) for df in dfs]
-    return all(cols == columns_list[0] for cols in columns_list)
+    first = dfs[0].columns
+    return all(len(df.columns) == len(first) and df.columns.isin(first).all() for df in dfs[1:])
+ 
+def load_upload(file, sheet_name):
+    """Load one uploaded file, using the selected sheet for Excel files."""
+    if file.name.endswith(("xlsx", "xls")):
+        return load_excel_sheet(file, sheet_name) if sheet_name else None
+    return read_csv(file)
  
 @st.cache_data(show_spinner=False)
 def append_files(files, selected_sheets):
     """Append files while validating column consistency."""
-    dfs = []
-    for file in files:
-        if file.name.endswith(("xlsx", "xls")):
-            sheet_name = selected_sheets.get(file.name)
-            if sheet_name:
-                df = load_excel_sheet(file, sheet_name)
-                if df is not None:
-                    dfs.append(df)
-        else:
-            df = read_csv(file)
-            if df is not None:
-                dfs.append(df)
+    # Files are parsed independently, so read them in parallel. Worker threads
+    # share the script context so their st.error messages still reach the page,
+    # and run in a copy of this context so the cache records them for replay
+    ctx = get_script_run_ctx()
+    tasks = [(contextvars.copy_context(), file) for file in files]
+    with ThreadPoolExecutor(max_workers=min(MAX_READ_WORKERS, len(files)), initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+        results = executor.map(lambda task: task[0].run(load_upload, task[1], selected_sheets.get(task[1].name)), tasks)
+        dfs = [df for df in results if df is not None]
  
     if dfs and validate_columns(dfs):
         return pd.concat(dfs, ignore_index=True)
@@ -78,10 +118,48 @@ def append_files(files, selected_sheets):
         st.error("Column mismatch detected. Ensure all files have the same structure.")
         return None
  
+def semi_join_mask(left, right_ids, right_has_missing):
+    """Mark which values of left appear in the identifiers built by build_id_index."""
+    left_na = pd.isna(left)
+    mask = np.zeros(len(left), dtype=bool)
+    mask[left_na] = right_has_missing
+    values = left[~left_na]
+    if isinstance(right_ids, pd.Index):
+        mask[~left_na] = pd.Series(values).isin(right_ids).to_numpy()
+    elif len(right_ids):
+        try:
+            idx = np.searchsorted(right_ids, values)
+            mask[~left_na] = (idx < len(right_ids)) & (right_ids[np.clip(idx, 0, len(right_ids) - 1)] == values)
+        except TypeError:
+            mask[~left_na] = pd.Series(values).isin(right_ids).to_numpy()
+    return mask
+ 
+@st.cache_data(show_spinner=False)
+def build_id_index(_df, file_id, col):
+    """Sort and de-duplicate an identifier column once so every P-C/C-P button can reuse it."""
+    ids = _df[col].to_numpy()
+    missing = pd.isna(ids)
+    try:
+        return np.unique(ids[~missing]), missing.any()
+    except TypeError:
+        # Identifiers mixing types can't be sorted, fall back to a hashed lookup
+        return pd.Index(pd.unique(ids[~missing])), missing.any()
+ 
 def preview_dataframe(df, n=5):
     """Preview the first few rows of a dataframe."""
     return df.head(n)
  
+# Summarization operations mapped to their pandas aggregation names
+SUMMARY_OPERATIONS = {
+    "Min": "min",
+    "Max": "max",
+    "Sum": "sum",
+    "Count": "count",
+    "Average": "mean",
+    "Median": "median",
+    "Standard Deviation": "std",
+}
+ 
 def summarize_csv_files(df, selected_operation, selected_columns, group_by_columns, include_all_columns=False):
     """Summarize data using the selected operation."""
     try:
@@ -89,33 +167,14 @@ def summarize_csv_files(df, selected_operation, selected_columns, group_by_colum
             st.warning("No grouping columns selected.")
             return pd.DataFrame()
  
-        grouped = df.groupby(group_by_columns)
-        results = {}
- 
-        for col in selected_columns:
-            if selected_operation == "Min":
-                results[col] = grouped[col].min()
-            elif selected_operation == "Max":
-                results[col] = grouped[col].max()
-            elif selected_operation == "Sum":
-                results[col] = grouped[col].sum()
-            elif selected_operation == "Count":
-                results[col] = grouped[col].count()
-            elif selected_operation == "Average":
-                results[col] = grouped[col].mean()
-            elif selected_operation == "Median":
-                results[col] = grouped[col].median()
-            elif selected_operation == "Standard Deviation":
-                results[col] = grouped[col].std()
- 
-        summary_df = pd.concat(results, axis=1).reset_index()
+        # Aggregate every column in a single pass over the groups
+        aggregations = {col: SUMMARY_OPERATIONS[selected_operation] for col in selected_columns}
  
         if include_all_columns:
             extra_cols = [col for col in df.columns if col not in selected_columns + group_by_columns]
-            for col in extra_cols:
-                summary_df[col] = grouped[col].first().values
+            aggregations.update({col: "first" for col in extra_cols})
  
-        return summary_df
+        return df.groupby(group_by_columns).agg(aggregations).reset_index()
  
     except Exception as e:
         st.error(f"Error during summarization: {e}")
@@ -161,12 +220,7 @@ if operation == "Append Files":
             st.write("### Preview of Combined Data")
             st.dataframe(preview_dataframe(st.session_state.combined_df))
            
-            output_filename = "combined_data.csv"
-            output_csv_path = os.path.join(TEMP_DIR, output_filename)
-            st.session_state.combined_df.to_csv(output_csv_path, index=False)
- 
-            with open(output_csv_path, "rb") as f:
-                st.download_button("Download Combined File", data=f, file_name=output_filename, mime="text/csv")
+            st.download_button("Download Combined File", data=convert_df_to_csv(st.session_state.combined_df), file_name="combined_data.csv", mime="text/csv")
  
 # Summarize Data Section
 elif operation == "Summarize Data":
@@ -204,7 +258,7 @@ elif operation == "Summarize Data":
  
             group_by_columns = st.multiselect("Select columns to group by:", all_columns)
             selected_columns = st.multiselect("Select numeric columns to summarize:", numeric_columns)
-            selected_operation = st.selectbox("Select summarization operation:", ["Min", "Max", "Sum", "Count", "Average", "Median", "Standard Deviation"])
+            selected_operation = st.selectbox("Select summarization operation:", list(SUMMARY_OPERATIONS))
             include_all_columns = st.checkbox("Include All Columns", value=False)
  
         with col2:
@@ -215,8 +269,7 @@ elif operation == "Summarize Data":
                 st.dataframe(summary_results)
  
                 if not summary_results.empty:
-                    csv = summary_results.to_csv(index=False).encode("utf-8")
-                    st.download_button("Download Summary", csv, "summary_results.csv", "text/csv")
+                    st.download_button("Download Summary", convert_df_to_csv(summary_results), "summary_results.csv", "text/csv")
 
 #P-C Section
 elif operation == "P-C and C-P":
@@ -226,24 +279,27 @@ elif operation == "P-C and C-P":
         commission_file = st.file_uploader("Upload Secondary File", type=["csv", "xlsx"])
 
     if premium_file and commission_file:
-        premium_df = pd.read_csv(premium_file, encoding="ISO-8859-1") if premium_file.name.endswith(".csv") else pd.read_excel(premium_file)
-        commission_df = pd.read_csv(commission_file, encoding="ISO-8859-1") if commission_file.name.endswith(".csv") else pd.read_excel(commission_file)
+        # Parsed frames are cached on the file contents, so button clicks don't re-read the uploads
+        premium_df = load_any(premium_file.getvalue(), premium_file.name)
+        commission_df = load_any(commission_file.getvalue(), commission_file.name)
+        if premium_df is None or commission_df is None:
+            st.stop()
 
         # Step 2: Preview the uploaded files one below the other
         st.markdown("<h3 class='step-header'>Step 2: Preview Uploaded Files</h3>", unsafe_allow_html=True)
 
         # Primary File Preview
         st.subheader("Primary File Preview")
-        st.dataframe(premium_df, height=200, use_container_width=True)  # Scrollbar enabled
+        st.dataframe(premium_df.head(500), height=200, use_container_width=True)  # Scrollbar enabled
         st.write(f"**Rows:** {premium_df.shape[0]}, **Columns:** {premium_df.shape[1]}")
 
         # Secondary File Preview
         st.subheader("Secondary File Preview")
-        st.dataframe(commission_df, height=200, use_container_width=True)  # Scrollbar enabled
+        st.dataframe(commission_df.head(500), height=200, use_container_width=True)  # Scrollbar enabled
         st.write(f"**Rows:** {commission_df.shape[0]}, **Columns:** {commission_df.shape[1]}")
 
         # Step 3: Check for Unique Identifier
-        common_columns = list(set(premium_df.columns) & set(commission_df.columns))
+        common_columns = premium_df.columns.intersection(commission_df.columns).tolist()
         st.markdown("<h3 class='step-header'>Step 3: Select Unique Identifier</h3>", unsafe_allow_html=True)
         
         if not common_columns:
@@ -255,6 +311,10 @@ elif operation == "P-C and C-P":
             with col2:
                 commission_identifier = st.selectbox("Select Identifier from Secondary File", commission_df.columns)
 
+            # Sorted identifiers are cached per upload, so all three buttons share them
+            premium_ids = build_id_index(premium_df, premium_file.file_id, premium_identifier)
+            commission_ids = build_id_index(commission_df, commission_file.file_id, commission_identifier)
+
             # Step 4: Choose Operation
             st.markdown("<h3 class='step-header'>Step 4: Choose Operation</h3>", unsafe_allow_html=True)
 
@@ -263,34 +323,33 @@ elif operation == "P-C and C-P":
 
             with col1:
                 if st.button("Exact Matches"):
-                    exact_matches = premium_df.merge(commission_df[[commission_identifier]], left_on=premium_identifier, right_on=commission_identifier, how='inner')
-                    exact_matches = exact_matches[premium_df.columns]  # Keep only primary table columns
+                    mask = semi_join_mask(premium_df[premium_identifier].to_numpy(), *commission_ids)
+                    exact_matches = premium_df[mask]
                     row_count, col_count = exact_matches.shape
                     with results_placeholder:
                         st.markdown("<h3 class='step-header'>Step 5: Exact Matches</h3>", unsafe_allow_html=True)
                         st.write(f"**Rows:** {row_count}, **Columns:** {col_count}")
-                        st.dataframe(exact_matches, height=400, use_container_width=True)
-                        st.download_button("Download Exact Matches", convert_df_to_excel(exact_matches), "exact_matches.csv", "text/csv")
+                        st.dataframe(exact_matches.head(500), height=400, use_container_width=True)
+                        st.download_button("Download Exact Matches", convert_df_to_csv(exact_matches), "exact_matches.csv", "text/csv")
 
             with col2:
                 if st.button("Records only in Primary"):
-                    premium_only = premium_df.merge(commission_df[[commission_identifier]], left_on=premium_identifier, right_on=commission_identifier, how='left', indicator=True)
-                    premium_only = premium_only[premium_only['_merge'] == 'left_only'].drop(columns=['_merge'])
+                    mask = ~semi_join_mask(premium_df[premium_identifier].to_numpy(), *commission_ids)
+                    premium_only = premium_df[mask]
                     row_count_p, col_count_p = premium_only.shape
                     with results_placeholder:
                         st.markdown("<h3 class='step-header'>Step 5: Records Only in Primary</h3>", unsafe_allow_html=True)
                         st.write(f"**Rows:** {row_count_p}, **Columns:** {col_count_p}")
-                        st.dataframe(premium_only, height=400, use_container_width=True)
-                        st.download_button("Download Primary-Only Records", convert_df_to_excel(premium_only), "primary_only.csv", "text/csv")
+                        st.dataframe(premium_only.head(500), height=400, use_container_width=True)
+                        st.download_button("Download Primary-Only Records", convert_df_to_csv(premium_only), "primary_only.csv", "text/csv")
 
             with col3:
                 if st.button("Records only in Secondary"):
-                    commission_only = commission_df.merge(premium_df[[premium_identifier]], left_on=commission_identifier, right_on=premium_identifier, how='left', indicator=True)
-                    commission_only = commission_only[commission_only['_merge'] == 'left_only'].drop(columns=['_merge'])
-                    commission_only = commission_only[commission_df.columns]  # Keep only secondary table columns
+                    mask = ~semi_join_mask(commission_df[commission_identifier].to_numpy(), *premium_ids)
+                    commission_only = commission_df[mask]
                     row_count_s, col_count_s = commission_only.shape
                     with results_placeholder:
                         st.markdown("<h3 class='step-header'>Step 5: Records Only in Secondary</h3>", unsafe_allow_html=True)
                         st.write(f"**Rows:** {row_count_s}, **Columns:** {col_count_s}")
-                        st.dataframe(commission_only, height=400, use_container_width=True)
-                        st.download_button("Download Secondary-Only Records", convert_df_to_excel(commission_only), "secondary_only.csv", "text/csv")
+                        st.dataframe(commission_only.head(500), height=400, use_container_width=True)
+                        st.download_button("Download Secondary-Only Records", convert_df_to_csv(commission_only), "secondary_only.csv", "text/csv")